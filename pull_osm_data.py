@@ -24,36 +24,58 @@
 #  Modified By: Godwin peter. O (me@godwin.dev)
 #  Modified At: Wed 29 Jan 2025 17:05:45
 
+import hashlib
 import logging
 import os
+import re
+import shutil
+import socket
+import subprocess
 import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple
 
 import boto3
 import osmium
 import requests
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
 
 # NOTE: Install these first
 # Resolve any virtual env issue
 # pip install --upgrade boto3 osmium
+# Optional: osmium-tool (the `osmium` CLI) for faster native merges
 
 ## Valid ENV Variables - .osm.env OR .env
 # DATA_DIR=./data
 # OSM_LOCATIONS=africa/mali,africa/togo
 # OSM_SOURCE=https://<source-url>
+# OSM_DL_CONCURRENCY=12
+# OSM_DL_PARTS=8
+# OSM_DL_RCVBUF_KB=0
 # S3_ENABLED=False
 # S3_ACCOUNT_ID=xx
 # S3_ENDPOINT_URL=xx
 # S3_BUCKET_NAME=xx
 # S3_ACCESS_KEY_ID=xx
 # S3_ACCESS_KEY_SECRET=xx
+# S3_PART_SIZE_MB=32
+# S3_CONCURRENCY=16
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+## KEY=value lines, comments and blank lines never match
+ENV_LINE_RE = re.compile(r"^[ \t]*([A-Za-z_]\w*)[ \t]*=[ \t]*(.*?)[ \t]*$", re.M)
+
 
 def load_env_file(input_env_file, override=False):
     dotenv_path: str = ".env"
@@ -67,15 +89,10 @@ def load_env_file(input_env_file, override=False):
         sys.exit()
 
     with open(dotenv_path) as file_obj:
-        lines = file_obj.read().splitlines()  # Removes \n from lines
+        text = file_obj.read()
 
     dotenv_vars = {}
-    for line in lines:
-        line = line.strip()
-        if not line or line.startswith("#") or "=" not in line:
-            continue
-
-        key, value = line.split("=", maxsplit=1)
+    for key, value in ENV_LINE_RE.findall(text):
         dotenv_vars.setdefault(key, value)
 
     if override:
@@ -96,7 +113,24 @@ DATA_DIR = os.getenv("DATA_DIR", "./")
 DOWNLOAD_DIR = f"{DATA_DIR}/osm_downloads"
 OSM_DIR = f"{DATA_DIR}/openstreetmap"
 OSM_SOURCE = os.getenv("OSM_SOURCE")
-S3_ENABLED: bool = eval(os.getenv("S3_ENABLED", "False"))
+OSM_DL_CONCURRENCY = int(os.getenv("OSM_DL_CONCURRENCY", "12"))
+## Files above the threshold are fetched as parallel byte ranges
+OSM_DL_PARTS = int(os.getenv("OSM_DL_PARTS", "8"))
+OSM_DL_RANGE_THRESHOLD = 32 * 1024 * 1024
+OSM_DL_CHUNK_SIZE = 1024 * 1024
+## PBF is already compressed, don't let the server gzip it again
+OSM_DL_HEADERS = {"Accept-Encoding": "identity"}
+## (connect, read) timeouts in seconds
+OSM_DL_TIMEOUT = (5, 60)
+## Response validators saved beside each download for conditional requests
+OSM_DL_VALIDATORS = {"ETag": ".etag", "Last-Modified": ".last-modified"}
+## Socket receive buffer, 0 keeps the kernel's auto-tuning (recommended on Linux)
+OSM_DL_RCVBUF_KB = int(os.getenv("OSM_DL_RCVBUF_KB", "0"))
+## Set explicitly, osmium can't infer the format from the temporary merge name.
+## Pelias doesn't use object metadata (versions, users, changesets), drop it.
+OSM_OUTPUT_FORMAT = "pbf,pbf_dense_nodes=true,add_metadata=false"
+OSM_OUTPUT_GENERATOR = "pelias-deploy"
+S3_ENABLED: bool = os.getenv("S3_ENABLED", "").lower() in ("1", "true", "yes")
 ## account_id - For cloudflare OR replace with S3 url
 S3_ACCOUNT_ID = os.getenv("S3_ACCOUNT_ID")
 S3_ENDPOINT_URL = os.getenv(
@@ -108,6 +142,42 @@ S3_CONFIG = {
     "access_key_id": os.getenv("S3_ACCESS_KEY_ID", ""),
     "access_key_secret": os.getenv("S3_ACCESS_KEY_SECRET", ""),
 }
+## S3/R2 reject parts under 5 MiB (except the last) and cap uploads at 10,000 parts
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MAX_PARTS = 10000
+S3_PART_SIZE = max(
+    int(os.getenv("S3_PART_SIZE_MB", "32")) * 1024 * 1024, S3_MIN_PART_SIZE
+)
+S3_CONCURRENCY = int(os.getenv("S3_CONCURRENCY", "16"))
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=max(32, S3_CONCURRENCY),
+    retries={"mode": "adaptive", "max_attempts": 10},
+)
+
+
+class SocketOptionsAdapter(HTTPAdapter):
+    """HTTPAdapter that applies download socket tuning to every connection."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        # urllib3's defaults already include TCP_NODELAY
+        socket_options = list(HTTPConnection.default_socket_options)
+        if OSM_DL_RCVBUF_KB > 0:
+            socket_options.append(
+                (socket.SOL_SOCKET, socket.SO_RCVBUF, OSM_DL_RCVBUF_KB * 1024)
+            )
+        kwargs["socket_options"] = socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+# Module-wide so every download reuses the same keep-alive connections
+SESSION = requests.Session()
+_adapter = SocketOptionsAdapter(
+    pool_connections=OSM_DL_CONCURRENCY,
+    pool_maxsize=OSM_DL_CONCURRENCY,
+    max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504]),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
 
 
 class OSMDownloaderMerger:
@@ -115,94 +185,510 @@ class OSMDownloaderMerger:
         self.base_url = base_url
         self.locations = locations
 
-        try:
-            if not os.path.exists(OSM_DIR):
-                os.makedirs(OSM_DIR)
+        # Caps open transfers across file and byte-range workers to the pool size
+        self.transfer_slots = threading.BoundedSemaphore(OSM_DL_CONCURRENCY)
+        # S3 clients are expensive to build, keep one per endpoint/credential set
+        self.s3_clients: Dict[Tuple[str, str, str], Any] = {}
 
-            if not os.path.exists(DOWNLOAD_DIR):
-                os.makedirs(DOWNLOAD_DIR)
-        except FileExistsError:
-            pass
+        Path(OSM_DIR).mkdir(parents=True, exist_ok=True)
+        Path(DOWNLOAD_DIR).mkdir(parents=True, exist_ok=True)
 
-    def needs_download(self, filepath: str) -> bool:
+    def needs_download(
+        self, filepath: str, stat: Optional[os.stat_result] = None
+    ) -> bool:
         """Check if file needs to be downloaded based on age or existence."""
-        if not os.path.exists(filepath):
-            return True
+        if stat is None:
+            if not os.path.exists(filepath):
+                return True
+            stat = os.stat(filepath)
 
-        file_time = datetime.fromtimestamp(os.path.getmtime(filepath))
+        file_time = datetime.fromtimestamp(stat.st_mtime)
         age = datetime.now() - file_time
         return age.days >= 7
 
-    def clean_old_merge(self, file_input: str):
-        logger.info("Cleaning up old merged file..")
-        file_path = Path(file_input)
+    def _is_stale(
+        self, url: str, filepath: str, existing: Set[str]
+    ) -> Tuple[bool, Optional[requests.Response]]:
+        """Revalidate a local file against the server with a conditional HEAD.
+
+        `existing` holds the names of the files in the download directory.
+        The HEAD response is returned along with the verdict when it carries
+        the full headers, so a stale file can be fetched without another HEAD.
+        """
+        name = os.path.basename(filepath)
+        if name not in existing:
+            return True, None
+        stat = os.stat(filepath)
+
+        validators = {
+            header: Path(f"{filepath}{suffix}").read_text().strip()
+            for header, suffix in OSM_DL_VALIDATORS.items()
+            if f"{name}{suffix}" in existing
+        }
+        etag = validators.get("ETag")
+        saved_last_modified = validators.get("Last-Modified")
+
+        # Echo the server's own validators back, local mtime is only a fallback
+        headers = {
+            **OSM_DL_HEADERS,
+            "If-Modified-Since": saved_last_modified
+            or formatdate(stat.st_mtime, usegmt=True),
+        }
+        if etag:
+            headers["If-None-Match"] = etag
+
         try:
-            file_path.unlink()
-            logger.info(f"{file_path} has been deleted successfully.")
-        except FileNotFoundError:
-            logger.error(f"{file_path} does not exist.")
-        except PermissionError:
-            logger.error(f"Permission denied: {file_path}.")
-        except Exception as e:
-            logger.error(f"Error occurred: {e}")
+            with self.transfer_slots:
+                head = SESSION.head(
+                    url, headers=headers, allow_redirects=True, timeout=OSM_DL_TIMEOUT
+                )
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Unable to revalidate {filepath}: {str(e)}")
+            return self.needs_download(filepath, stat), None
+
+        if head.status_code == 304:
+            return False, None
+        if not head.ok:
+            return self.needs_download(filepath, stat), None
+
+        stale = self._validators_changed(
+            head, filepath, stat, etag, saved_last_modified
+        )
+        return stale, head
+
+    def _validators_changed(
+        self,
+        head: requests.Response,
+        filepath: str,
+        stat: os.stat_result,
+        etag: Optional[str],
+        saved_last_modified: Optional[str],
+    ) -> bool:
+        """Compare a full HEAD response against what is known about the local file."""
+        # A saved validator that no longer matches means the file was republished
+        server_etag = head.headers.get("ETag")
+        if etag and server_etag is not None:
+            return server_etag != etag
+
+        last_modified = head.headers.get("Last-Modified")
+        if saved_last_modified and last_modified is not None:
+            return last_modified != saved_last_modified
+
+        try:
+            size = head.headers.get("Content-Length")
+            if size is not None and int(size) != stat.st_size:
+                return True
+
+            if last_modified is None:
+                return self.needs_download(filepath, stat)
+
+            return parsedate_to_datetime(last_modified).timestamp() > stat.st_mtime
+        except (TypeError, ValueError):
+            logger.warning(f"Unusable validators for {filepath}, checking its age")
+            return self.needs_download(filepath, stat)
+
+    def _fadvise(self, filepath: str, advice_name: str):
+        """Pass a page cache hint for a whole file to the kernel, if supported."""
+        advice = getattr(os, advice_name, None)
+        if advice is None:
+            return
+
+        fd = os.open(filepath, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, advice)
+        finally:
+            os.close(fd)
+
+    def _expected_md5(self, url: str) -> Optional[str]:
+        """Fetch the published `<url>.md5` checksum, if the source has one."""
+        try:
+            with self.transfer_slots:
+                response = SESSION.get(f"{url}.md5", timeout=OSM_DL_TIMEOUT)
+        except requests.exceptions.RequestException:
+            return None
+
+        if not response.ok or not response.text.strip():
+            return None
+
+        # Mirrors without checksums may answer 200 with an HTML page instead
+        checksum = response.text.split()[0].lower()
+        if not re.fullmatch(r"[0-9a-f]{32}", checksum):
+            return None
+        return checksum
+
+    def _file_md5(self, filename: str) -> str:
+        """Hash a file that could not be hashed while it was streamed."""
+        digest = hashlib.md5()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(OSM_DL_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _single_download(
+        self, url: str, filename: str
+    ) -> Tuple[Mapping[str, str], str]:
+        """Download a file over a single connection.
+
+        Returns the response headers and the MD5 of the body, hashed as it
+        is written so the file never has to be read back.
+        """
+        digest = hashlib.md5()
+        with self.transfer_slots:
+            response = SESSION.get(
+                url, headers=OSM_DL_HEADERS, stream=True, timeout=OSM_DL_TIMEOUT
+            )
+            response.raise_for_status()
+
+            with open(filename, "wb") as f:
+                for chunk in response.iter_content(chunk_size=OSM_DL_CHUNK_SIZE):
+                    f.write(chunk)
+                    digest.update(chunk)
+
+        return response.headers, digest.hexdigest()
+
+    def _ranged_download(
+        self,
+        url: str,
+        filename: str,
+        head: Optional[requests.Response] = None,
+        parts: int = OSM_DL_PARTS,
+    ) -> Optional[Mapping[str, str]]:
+        """Download a large file as parallel byte ranges, returning its headers.
+
+        `head` is a HEAD response already fetched for `url`, if any. Returns
+        None when the file is small or the server does not honour range
+        requests, leaving the caller to use a single stream instead.
+        """
+        if head is None:
+            with self.transfer_slots:
+                head = SESSION.head(
+                    url,
+                    headers=OSM_DL_HEADERS,
+                    allow_redirects=True,
+                    timeout=OSM_DL_TIMEOUT,
+                )
+                head.raise_for_status()
+
+        size = int(head.headers.get("Content-Length", 0))
+        if (
+            parts < 2
+            or size < OSM_DL_RANGE_THRESHOLD
+            or head.headers.get("Accept-Ranges") == "none"
+        ):
+            return None
+
+        part_size = -(-size // parts)
+        ranges = [
+            (start, min(start + part_size, size) - 1)
+            for start in range(0, size, part_size)
+        ]
+
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+
+            def _fetch_range(start: int, end: int) -> bool:
+                headers = {**OSM_DL_HEADERS, "Range": f"bytes={start}-{end}"}
+                # A file replaced mid-download comes back as a full 200
+                if "ETag" in head.headers:
+                    headers["If-Range"] = head.headers["ETag"]
+                with self.transfer_slots:
+                    response = SESSION.get(
+                        head.url, headers=headers, stream=True, timeout=OSM_DL_TIMEOUT
+                    )
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        response.close()
+                        return False
+
+                    offset = start
+                    for chunk in response.iter_content(chunk_size=OSM_DL_CHUNK_SIZE):
+                        os.pwrite(fd, chunk, offset)
+                        offset += len(chunk)
+
+                if offset != end + 1:
+                    raise requests.exceptions.RequestException(
+                        f"Incomplete range {start}-{end} for {url}"
+                    )
+                return True
+
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                futures = [executor.submit(_fetch_range, a, b) for a, b in ranges]
+                results = [future.result() for future in futures]
+        finally:
+            os.close(fd)
+
+        if not all(results):
+            logger.info(f"Range requests not supported for {url}, using one stream")
+            return None
+
+        return head.headers
 
     def download_files(self) -> List[str]:
-        """Download OSM files if needed."""
-        downloaded_files = []
+        """Download OSM files if needed, in the configured location order."""
+        ready = dict(self._iter_completed())
+
+        # Keep the configured location order regardless of completion order
+        return [ready[loc] for loc in self.locations if loc in ready]
+
+    def iter_downloads(self) -> Iterator[str]:
+        """Download OSM files if needed, yielding each one once it is on disk.
 
-        for loc in self.locations:
+        Files come out in completion order, not the configured order.
+        """
+        for _, filename in self._iter_completed():
+            yield filename
+
+    def _iter_completed(self) -> Iterator[Tuple[str, str]]:
+        """Run the downloads, yielding (location, filename) as each succeeds."""
+        # One directory scan answers every existence check, sidecars included;
+        # is_file() comes from d_type, only the extracts themselves get stat'ed
+        existing = {
+            entry.name for entry in os.scandir(DOWNLOAD_DIR) if entry.is_file()
+        }
+
+        def _download_one(loc: str) -> Tuple[str, str, bool]:
             paths = loc.split("/")
             country = paths[1]
             filename = f"{DOWNLOAD_DIR}/{country}-latest.osm.pbf"
             filepath = f"{loc}-latest.osm.pbf"
 
-            if self.needs_download(filename):
-                url = f"{self.base_url}/{filepath}"
-                logger.info(f"Downloading OSM file for {loc}")
+            url = f"{self.base_url}/{filepath}"
+            # Write to a side file so a failed transfer never looks fresh
+            part_file = f"{filename}.part"
+            try:
+                stale, head = self._is_stale(url, filename, existing)
+                if not stale:
+                    return loc, filename, True
 
+                logger.info(f"Downloading OSM file for {loc}")
+                headers = self._ranged_download(url, part_file, head)
+                if headers is None:
+                    headers, md5 = self._single_download(url, part_file)
+                else:
+                    # Ranges arrive out of order, hash the (still cached) file
+                    md5 = self._file_md5(part_file)
+
+                expected_md5 = self._expected_md5(url)
+                if expected_md5 is not None and md5 != expected_md5:
+                    raise OSError(f"Checksum mismatch for {url}")
+                os.replace(part_file, filename)
+
+                for header, suffix in OSM_DL_VALIDATORS.items():
+                    validator_file = Path(f"{filename}{suffix}")
+                    if header in headers:
+                        validator_file.write_text(headers[header])
+                    else:
+                        validator_file.unlink(missing_ok=True)
+
+                logger.info(f"Successfully downloaded {loc} OSM data")
+            except (requests.exceptions.RequestException, OSError) as e:
+                logger.error(f"Failed to download {loc} OSM data: {str(e)}")
+                Path(part_file).unlink(missing_ok=True)
+                return loc, filename, False
+
+            return loc, filename, True
+
+        with ThreadPoolExecutor(max_workers=OSM_DL_CONCURRENCY) as executor:
+            futures = {
+                executor.submit(_download_one, loc): loc for loc in self.locations
+            }
+            for future in as_completed(futures):
+                # One bad location must not cancel the rest of the batch
                 try:
-                    response = requests.get(url, stream=True)
-                    response.raise_for_status()
-
-                    with open(filename, "wb") as f:
-                        for chunk in response.iter_content(chunk_size=8192):
-                            f.write(chunk)
-
-                    logger.info(f"Successfully downloaded {loc} OSM data")
-                except requests.exceptions.RequestException as e:
+                    loc, filename, ok = future.result()
+                except Exception as e:
+                    loc = futures[future]
                     logger.error(f"Failed to download {loc} OSM data: {str(e)}")
                     continue
-
-            downloaded_files.append(filename)
-
-        return downloaded_files
+                if ok:
+                    yield loc, filename
 
     def merge_files(
-        self, input_files: List[str], output_file: str = "all.osm.pbf"
+        self, input_files: Iterable[str], output_file: str = "all.osm.pbf"
     ) -> Optional[str]:
-        """Merge downloaded OSM files using osmium."""
-        try:
-            logger.info("Starting merge process")
-
-            self.clean_old_merge(output_file)
-            handler = osmium.SimpleWriter(output_file)
-            reader = osmium.MergeInputReader()
-
+        """Merge downloaded OSM files using osmium.
+
+        `input_files` may be lazy, e.g. `iter_downloads()`. Only per-file
+        preparation (readahead, sort checks, sorting unsorted inputs) overlaps
+        the remaining downloads; the merge itself starts once all have arrived.
+        """
+        # Merge next to the target and swap it in, so readers never see a
+        # partial file and a failed merge keeps the previous one
+        tmp_file = f"{output_file}.tmp"
+        merged_inputs: List[str] = []
+
+        def _arrivals() -> Iterator[str]:
             for input_file in input_files:
                 logger.info(f"Processing {input_file}")
+                # Start readahead right away so the merge doesn't stall on faults
+                self._fadvise(input_file, "POSIX_FADV_WILLNEED")
+                merged_inputs.append(input_file)
+                yield input_file
 
-                reader.add_file(input_file)
+        try:
+            logger.info("Starting merge process")
 
-            reader.apply(handler)
+            if shutil.which("osmium"):
+                self._merge_native(_arrivals(), tmp_file)
+            else:
+                logger.warning("osmium binary not found, merging with pyosmium")
+                self._merge_python(_arrivals(), tmp_file)
+            os.replace(tmp_file, output_file)
 
             logger.info(f"Successfully merged files into {output_file}")
 
+            # Inputs are read exactly once per run, don't let them crowd the cache
+            for input_file in merged_inputs:
+                self._fadvise(input_file, "POSIX_FADV_DONTNEED")
+
             return output_file
 
         except Exception as e:
             logger.error(f"Failed to merge files: {str(e)}")
+            Path(tmp_file).unlink(missing_ok=True)
             return None
 
+    def _is_sorted(self, input_file: str) -> bool:
+        """Check the PBF header for the Type_then_ID sort flag."""
+        reader = osmium.io.Reader(input_file, osmium.osm.osm_entity_bits.NOTHING)
+        try:
+            return reader.header().get("sorting") == "Type_then_ID"
+        finally:
+            reader.close()
+
+    def _sort_inputs(self, input_files: Iterable[str], work_dir: str) -> List[str]:
+        """Sort any unsorted inputs in parallel, one osmium process per file."""
+
+        def _sorted_path(input_file: str) -> str:
+            if self._is_sorted(input_file):
+                return input_file
+
+            logger.info(f"Sorting {input_file}")
+            sorted_file = os.path.join(work_dir, os.path.basename(input_file))
+            subprocess.run(
+                ["osmium", "sort", "-o", sorted_file, "--overwrite", input_file],
+                check=True,
+            )
+            return sorted_file
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+            return list(executor.map(_sorted_path, input_files))
+
+    def _merge_native(self, input_files: Iterable[str], output_file: str):
+        """Merge with the osmium CLI, keeping decode/encode inside libosmium."""
+        # osmium merge is a streaming k-way merge and requires sorted inputs
+        work_dir = os.path.dirname(os.path.abspath(output_file))
+        with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+            # Each input's sort check (and sort, if needed) starts as it arrives.
+            # Geofabrik extracts are pre-sorted, so that is just a header read.
+            sorted_files = self._sort_inputs(input_files, tmp_dir)
+            if not sorted_files:
+                raise ValueError("No files were downloaded or found locally")
+
+            subprocess.run(
+                [
+                    "osmium",
+                    "merge",
+                    "-o",
+                    output_file,
+                    "-f",
+                    OSM_OUTPUT_FORMAT,
+                    "--generator",
+                    OSM_OUTPUT_GENERATOR,
+                    "--overwrite",
+                    *sorted_files,
+                ],
+                check=True,
+            )
+
+    def _merge_python(self, input_files: Iterable[str], output_file: str):
+        """Merge through pyosmium's in-memory MergeInputReader."""
+        reader = osmium.MergeInputReader()
+
+        # add_file holds the GIL while it loads, so this gains no real overlap
+        # with downloads still in flight; it only starts as soon as files exist
+        loaded = 0
+        for input_file in input_files:
+            reader.add_file(input_file)
+            loaded += 1
+
+        if not loaded:
+            raise ValueError("No files were downloaded or found locally")
+
+        header = osmium.io.Header()
+        header.set("generator", OSM_OUTPUT_GENERATOR)
+        handler = osmium.SimpleWriter(
+            osmium.io.File(output_file, OSM_OUTPUT_FORMAT),
+            header=header,
+            overwrite=True,
+        )
+        reader.apply(handler)
+        handler.close()
+
+    def _get_s3_client(
+        self, endpoint_url: str, access_key_id: str, access_key_secret: str
+    ):
+        """Return a cached R2 client for the given endpoint and credentials."""
+        key = (endpoint_url, access_key_id, access_key_secret)
+        if key not in self.s3_clients:
+            # Configure R2 client
+            self.s3_clients[key] = boto3.client(
+                service_name="s3",
+                endpoint_url=endpoint_url,
+                aws_access_key_id=access_key_id,
+                aws_secret_access_key=access_key_secret,
+                config=S3_CLIENT_CONFIG,
+            )
+
+        return self.s3_clients[key]
+
+    def _multipart_upload(
+        self, s3_client, file_path: str, bucket_name: str, key: str
+    ):
+        """Upload a large file in parallel parts read straight from one fd.
+
+        Each of the S3_CONCURRENCY workers holds one part in memory as it is
+        sent, i.e. 16 x 32 MiB = 512 MiB with the defaults.
+        """
+        size = os.path.getsize(file_path)
+        part_size = max(S3_PART_SIZE, -(-size // S3_MAX_PARTS))
+        offsets = range(0, size, part_size)
+
+        upload = s3_client.create_multipart_upload(Bucket=bucket_name, Key=key)
+        upload_id = upload["UploadId"]
+
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            def _upload_part(part_number: int, offset: int) -> Dict:
+                response = s3_client.upload_part(
+                    Bucket=bucket_name,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                    Body=os.pread(fd, part_size, offset),
+                )
+                return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+            with ThreadPoolExecutor(max_workers=S3_CONCURRENCY) as executor:
+                parts = list(
+                    executor.map(_upload_part, range(1, len(offsets) + 1), offsets)
+                )
+
+            s3_client.complete_multipart_upload(
+                Bucket=bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except Exception:
+            s3_client.abort_multipart_upload(
+                Bucket=bucket_name, Key=key, UploadId=upload_id
+            )
+            raise
+        finally:
+            os.close(fd)
+
     def upload_to_r2(
         self,
         file_path: str,
@@ -215,19 +701,17 @@ class OSMDownloaderMerger:
         try:
             logger.info("Initiating upload to Cloudflare R2")
 
-            # Configure R2 client
-            s3_client = boto3.client(
-                service_name="s3",
-                endpoint_url=endpoint_url,
-                aws_access_key_id=access_key_id,
-                aws_secret_access_key=access_key_secret,
+            s3_client = self._get_s3_client(
+                endpoint_url, access_key_id, access_key_secret
             )
 
             # Upload file
-            with open(file_path, "rb") as file_data:
-                s3_client.upload_fileobj(
-                    file_data, bucket_name, os.path.basename(file_path)
-                )
+            key = os.path.basename(file_path)
+            if os.path.getsize(file_path) <= S3_PART_SIZE:
+                with open(file_path, "rb") as file_data:
+                    s3_client.put_object(Body=file_data, Bucket=bucket_name, Key=key)
+            else:
+                self._multipart_upload(s3_client, file_path, bucket_name, key)
 
             logger.info(f"Successfully uploaded {file_path} to R2")
             return True
@@ -243,14 +727,10 @@ def main():
         sys.exit()
     else:
         osm_handler = OSMDownloaderMerger(OSM_SOURCE, all_locations)
-        downloaded_files: List[str] = osm_handler.download_files()
-
-        if not downloaded_files:
-            logger.error("No files were downloaded or found locally")
-            return
 
+        # Per-file merge preparation starts as each download finishes
         merged_file: str | None = osm_handler.merge_files(
-            downloaded_files, f"{OSM_DIR}/{output_name}.osm.pbf"
+            osm_handler.iter_downloads(), f"{OSM_DIR}/{output_name}.osm.pbf"
         )
         if not merged_file:
             logger.error("Failed to merge files")